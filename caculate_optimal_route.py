@@ -1,19 +1,143 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
+from pyproj import Geod
+import httpx
+import requests
 import openrouteservice as ors
 from openrouteservice import exceptions
 import re
 from openrouteservice.optimization import Vehicle, Job
-from shapely.geometry import Point, LineString
 import os
+import json
+import hashlib
+import functools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from diskcache import Cache
 from dotenv import load_dotenv
 
-# Set OpenRouteService API key
 load_dotenv()
-ors_api_key = os.environ.get('OPENROUTESERVICE_KEY')
-if not ors_api_key:
-    raise ValueError("OPENROUTESERVICE_KEY environment variable not set.")
-ors_client = ors.Client(key=ors_api_key)
+
+class HTTP2Client(ors.Client):
+    # ORS client on a pooled HTTP/2 httpx session, so consecutive/concurrent ORS calls reuse one keep-alive connection.
+    # Client-level requests options (verify, cert, proxies, allow_redirects) are mapped to their httpx equivalents
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session.close()
+        limits = httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60)
+        tls_options = {key: self._requests_kwargs.pop(key) for key in ('verify', 'cert') if key in self._requests_kwargs}
+        proxies = self._requests_kwargs.pop('proxies', None) or {}
+        mounts = {
+            scheme if '://' in scheme else f"{scheme}://": httpx.HTTPTransport(http2=True, limits=limits, proxy=proxy, **tls_options)
+            for scheme, proxy in proxies.items() if proxy
+        }
+        self._session = httpx.Client(
+            http2=True, limits=limits, mounts=mounts or None, timeout=self._timeout,
+            follow_redirects=self._requests_kwargs.pop('allow_redirects', True), **tls_options
+        )
+
+    # Raise httpx failures as the exceptions of the requests-based client: ORS Timeout for timeouts (as
+    # ors.Client.request does for requests timeouts) and requests' ConnectionError for other transport errors
+    def request(self, *args, **kwargs):
+        try:
+            return super().request(*args, **kwargs)
+        except httpx.TimeoutException:
+            raise exceptions.Timeout()
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+# The ORS client is created on first use (not at import) and then shared, so its connection pool is reused across calls
+@functools.lru_cache(maxsize=1)
+def get_ors_client():
+    # Set OpenRouteService API key
+    ors_api_key = os.environ.get('OPENROUTESERVICE_KEY')
+    if not ors_api_key:
+        raise ValueError("OPENROUTESERVICE_KEY environment variable not set.")
+    return HTTP2Client(key=ors_api_key)
+
+# Persistent cache of ORS responses so that re-processing the same stops does not call the API again
+ors_cache = Cache(os.path.join(tempfile.gettempdir(), 'ors_cache'))
+ors_cache_expire = 30 * 24 * 3600  # seconds (30 days)
+
+# Ellipsoid used for segment length calculations
+geod = Geod(ellps='WGS84')
+
+# Worker threads for ORS requests that can overlap with local processing
+ors_executor = ThreadPoolExecutor(max_workers=4)
+
+def round_coordinates(value):
+    # Round every float in a (nested) request payload to 6 decimals (~0.1 m) so that float jitter doesn't defeat the cache
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, (list, tuple)):
+        return [round_coordinates(item) for item in value]
+    return value
+
+def cached_ors(kind, request, call):
+    # Return the cached ORS response for this request, calling the API (and caching the result) only on a miss
+    key = hashlib.blake2b(json.dumps({'kind': kind, **round_coordinates(request)}, sort_keys=True).encode()).hexdigest()
+    response = ors_cache.get(key)
+    if response is None:
+        response = call()
+        ors_cache.set(key, response, expire=ors_cache_expire)
+    return response
+
+# Coordinates reported in ORS error messages: "Could not find routable point ... coordinate N: lon lat"
+# and "Unfound route(s) from location [lon,lat]"
+unroutable_point_pattern = re.compile(r"coordinate \d+: (-?\d+\.?\d*)\s+(-?\d+\.?\d*)")
+unfound_route_pattern = re.compile(r"location \[(-?\d+\.?\d*),(-?\d+\.?\d*)\]")
+
+# Accepted coordinate column names (lowercased) and their harmonized names
+coordinate_columns = {'latitude': 'lat', 'longitude': 'lon', 'y': 'lat', 'x': 'lon'}
+
+# ORS road surface codes (https://giscience.github.io/openrouteservice/api-reference/endpoints/directions/extra-info/surface)
+surface_codes = {
+    0: "Unknown", 1: "Paved", 2: "Unpaved", 3: "Asphalt", 4: "Concrete",
+    6: "Metal", 7: "Wood", 8: "Compacted Gravel", 10: "Gravel", 11: "Dirt",
+    12: "Ground", 13: "Ice", 14: "Paving Stones", 15: "Sand", 17: "Grass",
+    18: "Grass Paver"
+}
+# Surface names as a categorical dtype, plus a lookup array from surface code to category code
+# (indexed by surface code; the trailing "Unknown" catches any code above the known range)
+surface_dtype = pd.CategoricalDtype(categories=list(dict.fromkeys(surface_codes.values())))
+surface_lookup = np.array(
+    [surface_dtype.categories.get_loc(surface_codes.get(code, "Unknown")) for code in range(max(surface_codes) + 2)],
+    dtype=np.int8
+)
+
+def get_directions(ordered_coords):
+    return cached_ors(
+        'directions',
+        {'coordinates': ordered_coords, 'profile': 'driving-car', 'extra_info': ['surface']},
+        lambda: get_ors_client().directions(
+            coordinates=ordered_coords,
+            profile='driving-car',
+            extra_info=['surface'],
+            format='geojson'
+        )
+    )
+
+def add_road_surface_id(route_geometry, details):
+    # Numeric work on plain arrays first, then a single GeoDataFrame built at the end
+    coords = np.asarray(route_geometry['coordinates'], dtype=float)
+    n_segments = len(coords) - 1
+
+    # Surface runs are contiguous [start, end) waypoint ranges, so segment i takes the id of its run
+    starts, ends, surface_ids = np.asarray(details, dtype=np.int64).reshape(-1, 3).T
+    runs = np.repeat(surface_ids, ends - starts)[:n_segments]
+    surface = np.zeros(n_segments, dtype=np.int16)
+    surface[:len(runs)] = runs
+    surface = pd.Categorical.from_codes(surface_lookup[np.minimum(surface, len(surface_lookup) - 1)], dtype=surface_dtype)
+
+    # Geodesic length (m) of each segment, straight from the vertex array in one vectorized call (no reprojection)
+    _, _, segment_length = geod.inv(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+
+    # One two-point LineString per pair of consecutive vertices, built in a single vectorized call
+    segments = shapely.linestrings(np.stack([coords[:-1], coords[1:]], axis=1))
+
+    return gpd.GeoDataFrame({'surface': surface, 'segment_length': segment_length}, geometry=segments, crs='EPSG:4326')
 
 def optimal_route(input_source, input_destinations, input_dest_id_field, input_final_stop):  
     # Clean column names and prepare data
@@ -26,17 +150,18 @@ def optimal_route(input_source, input_destinations, input_dest_id_field, input_f
     # Harmonize coordinate column names
     for df in [source, final_stop, destinations]:
         df.columns = df.columns.str.lower()
-        df.rename(columns={'latitude': 'lat', 'longitude': 'lon', 'y': 'lat', 'x': 'lon'}, inplace=True)
+        df.rename(columns=coordinate_columns, inplace=True)
 
-    # Convert to GeoDataFrames
-    source = gpd.GeoDataFrame(source, geometry=gpd.points_from_xy(source.lon, source.lat), crs="EPSG:4326")
-    final_stop = gpd.GeoDataFrame(final_stop, geometry=gpd.points_from_xy(final_stop.lon, final_stop.lat), crs="EPSG:4326")
-    destinations = gpd.GeoDataFrame(destinations, geometry=gpd.points_from_xy(destinations.lon, destinations.lat), crs="EPSG:4326")
+    # Convert to GeoDataFrames (each input's points are built in one vectorized GEOS call)
+    source, final_stop, destinations = (
+        gpd.GeoDataFrame(df, geometry=shapely.points(df['lon'].to_numpy(dtype=float), df['lat'].to_numpy(dtype=float)), crs="EPSG:4326")
+        for df in [source, final_stop, destinations]
+    )
 
     # Create vehicle and jobs objects
     home_base = source.geometry.iloc[0].coords[0]
     final_dest = final_stop.geometry.iloc[0].coords[0]
-    stops = destinations.geometry.apply(lambda geom: geom.coords[0]).tolist()
+    stops = np.column_stack([destinations.geometry.x.to_numpy(), destinations.geometry.y.to_numpy()]).tolist()
 
     vehicle = Vehicle(id=1, profile="driving-hgv", start=home_base, end=final_dest)
     jobs = [Job(id=i+1, location=loc, priority=1) for i, loc in enumerate(stops)]
@@ -49,13 +174,20 @@ def optimal_route(input_source, input_destinations, input_dest_id_field, input_f
     final_stop_name = input_final_stop.get('name', pd.Series(['Final stop'])).iloc[0]
     all_points_for_lookup.append({'name': final_stop_name, 'lon': final_stop.geometry.x.iloc[0], 'lat': final_stop.geometry.y.iloc[0]})
 
-    for _, row in destinations.iterrows():
-        point_name = row[input_dest_id_field] if input_dest_id_field in row else "Unnamed Destination"
-        all_points_for_lookup.append({'name': point_name, 'lon': row.geometry.x, 'lat': row.geometry.y})
+    if input_dest_id_field in destinations.columns:
+        point_names = destinations[input_dest_id_field].tolist()
+    else:
+        point_names = ["Unnamed Destination"] * len(destinations)
+    all_points_for_lookup.extend({'name': point_name, 'lon': lon, 'lat': lat} for point_name, (lon, lat) in zip(point_names, stops))
     
     try:
-        # Get the optimized itinerary
-        opt = ors_client.optimization(jobs=jobs, vehicles=[vehicle], geometry=True)
+        # Get the optimized itinerary (from the cache if these stops were already optimized; the stop order is
+        # part of the key because the job ids in the response are positions in `stops`)
+        opt = cached_ors(
+            'optimization',
+            {'home': home_base, 'end': final_dest, 'stops': stops, 'profile': 'driving-hgv'},
+            lambda: get_ors_client().optimization(jobs=jobs, vehicles=[vehicle], geometry=True)
+        )
 
     # Handle various error types given the returned error messages from the API
     except exceptions.ApiError as e:
@@ -64,14 +196,14 @@ def optimal_route(input_source, input_destinations, input_dest_id_field, input_f
 
         # Handle "Could not find routable point" error
         if 'Could not find routable point' in error_message:
-            match = re.search(r"coordinate \d+: (-?\d+\.?\d*)\s+(-?\d+\.?\d*)", error_message)
+            match = unroutable_point_pattern.search(error_message)
             if match:
                 lon_err, lat_err = float(match.group(1)), float(match.group(2))
 
         # Handle "Unfound route(s) from location" for start/end/multiple destinations
         elif 'Unfound route(s) from location' in error_message:
             # This error uses [lon,lat] format
-            match = re.search(r"location \[(-?\d+\.?\d*),(-?\d+\.?\d*)\]", error_message)
+            match = unfound_route_pattern.search(error_message)
             if match:
                 lon_err, lat_err = float(match.group(1)), float(match.group(2))
 
@@ -89,127 +221,84 @@ def optimal_route(input_source, input_destinations, input_dest_id_field, input_f
         raise e
 
     steps = opt['routes'][0]['steps'] 
-    
-    job_sequence = pd.DataFrame([
-        {'job': item.get('job'), 'distance': item.get('distance'), 'location': item['location']} 
-        for item in steps 
-        if item.get('job') is not None
-    ])
-    job_sequence = job_sequence.sort_values( by='distance') 
-    job_sequence = job_sequence.reset_index(drop=False).rename(columns={'index': 'rank'})
-    job_sequence['rank'] = job_sequence['rank'] + 1
-
-    job_sequence['lon'] = job_sequence['location'].apply(lambda loc: loc[0])
-    job_sequence['lat'] = job_sequence['location'].apply(lambda loc: loc[1])
-
-    gdf = gpd.GeoDataFrame(
-        job_sequence, 
-        geometry=[Point(xy) for xy in zip(job_sequence['lon'], job_sequence['lat'])],
-        crs="EPSG:4326"
-    )
-    
-    gdf = gdf.drop(columns=['location', 'lat', 'lon'])
 
-    gdf = gdf.to_crs(gdf.estimate_utm_crs()) 
-    gdf['geometry'] = gdf['geometry'].buffer(10)
-    gdf = gdf.to_crs('EPSG:4326')
+    # Walk the steps once, splitting them into columns (no per-step dicts for pandas to re-parse)
+    step_types, step_jobs, step_locations, step_distances = (list(column) for column in zip(*(
+        (step.get('type'), step.get('job'), step['location'], step.get('distance')) for step in steps
+    )))
+    step_coords = np.array(step_locations, dtype=float)
+    locations = pd.DataFrame({
+        'type': step_types,
+        'job': step_jobs,
+        'location': step_locations,
+        'distance': step_distances,
+        'lon': step_coords[:, 0],
+        'lat': step_coords[:, 1]
+    })
 
-    destinations = gpd.sjoin(destinations, gdf, how="left", predicate="intersects")
-    destinations['name'] = 'Destination ' + destinations['rank'].astype(str)
-    cols = ['name'] + [col for col in destinations if col != 'name']
-    destinations = destinations[cols]
-    destinations = destinations.sort_values(by='rank')
-    destinations = destinations[['name', input_dest_id_field, 'distance', 'geometry']]
+    # Sort the steps by cumulative distance once (stable, so ties keep the ORS order); rank is the position in the itinerary
+    locations = locations.sort_values(by='distance', kind='mergesort', ignore_index=True)
+    locations['rank'] = np.arange(len(locations))
 
-    locations = pd.DataFrame(steps, columns=['type', 'job', 'location', 'distance'])
-    locations = locations.sort_values( by='distance')
-    locations = locations.reset_index(drop=False).rename(columns={'index': 'rank'})
+    # The visited jobs keep their itinerary rank (the starting point is rank 0, so jobs are ranked from 1)
+    job_sequence = locations.loc[locations['job'].notna(), ['job', 'distance', 'rank']]
 
-    locations[['lon', 'lat']] = pd.DataFrame(locations['location'].tolist(), index=locations.index)
     locations.rename(columns={'type': 'name'}, inplace=True)
-    locations['name'] = locations.apply(lambda row: 
-                                        f'destination {int(row["rank"])}' 
-                                        if row['name'] == 'job' else ('home_base' 
-                                                                    if row['name'] == 'start' else 'final_stop'), axis=1)
+    step_types = locations['name'].to_numpy()
+    locations['name'] = np.select(
+        [step_types == 'job', step_types == 'start'],
+        [('destination ' + locations['rank'].astype(str)).to_numpy(dtype=object), 'home_base'],
+        default='final_stop'
+    )
     ordered_coords = locations['location'].tolist()
     locations.drop(columns=['rank', 'job', 'location'], inplace=True)
 
+    # Request the detailed route in the background while the destinations are post-processed
+    directions_future = ors_executor.submit(get_directions, ordered_coords)
+
+    # Job ids are the 1-based positions of the stops, i.e. of the destination rows: attach rank and distance by position
+    job_positions = job_sequence['job'].to_numpy(dtype=np.int64) - 1
+    matched_jobs = job_sequence[['rank', 'distance']].set_index(destinations.index[job_positions])
+    destinations = destinations.join(matched_jobs)
+
+    destinations['name'] = 'Destination ' + destinations['rank'].astype(str)
+    destinations = destinations.sort_values(by='rank').loc[:, ['name', input_dest_id_field, 'distance', 'geometry']]
+
+    # One row per leg between consecutive stops, built directly from the stop arrays (distances are cumulative, in m)
+    stop_names = locations['name'].to_numpy(dtype=object)
+    stop_lons = locations['lon'].to_numpy(dtype=float)
+    stop_lats = locations['lat'].to_numpy(dtype=float)
+    stop_distances = locations['distance'].to_numpy(dtype=float)
     route_segments = pd.DataFrame({
-        'segment_name': locations['name'].shift(1, fill_value='home_base') + ' to ' + locations['name'],
-        'origin_lon': locations['lon'].shift(1),
-        'origin_lat': locations['lat'].shift(1),
-        'end_lon': locations['lon'],
-        'end_lat': locations['lat'],
-        'distance': locations['distance']
+        'segment_name': stop_names[:-1] + ' to ' + stop_names[1:],
+        'origin_lon': stop_lons[:-1],
+        'origin_lat': stop_lats[:-1],
+        'end_lon': stop_lons[1:],
+        'end_lat': stop_lats[1:],
+        'distance': np.round(np.diff(stop_distances) / 1000, 2)
     })
 
-    route_segments['distance'] = route_segments['distance'].diff()
-    route_segments['distance'] = (route_segments['distance']/1000).round(2)
-    route_segments = route_segments.iloc[1:].reset_index(drop=True)
-
     dest_names = destinations[['name', input_dest_id_field]]
     dest_names = dest_names.assign(name=dest_names['name'].str.lower())
     dest_names = dest_names.set_index('name')[input_dest_id_field].to_dict()
 
-    def replace_names(text, name_list):
-        for key, value in name_list.items():
-            text = text.replace(key, value)
-        return text
-
-    route_segments['segment_name'] = route_segments['segment_name'].apply(lambda x: replace_names(x, dest_names))
+    # Swap the generic destination labels for their IDs in one regex pass (longest first so 'destination 1' can't match inside 'destination 10')
+    if dest_names:
+        names_pattern = re.compile('|'.join(re.escape(key) for key in sorted(dest_names, key=len, reverse=True)))
+        route_segments['segment_name'] = route_segments['segment_name'].str.replace(
+            names_pattern, lambda match: str(dest_names[match.group(0)]), regex=True
+        )
 
-    directions = ors_client.directions(
-        coordinates=ordered_coords,
-        profile='driving-car',
-        extra_info=['surface'],
-        format='geojson'
-    )
+    directions = directions_future.result()
 
     surface_details = directions['features'][0]['properties']['extras']['surface']['values']
     surface_summary = directions['features'][0]['properties']['extras']['surface']['summary']
     route_geom = directions['features'][0]['geometry']
     
-    def add_road_surface_id(route_geometry, details):
-        coords = route_geometry['coordinates']
-        route = LineString(coords)
-        gdf = gpd.GeoDataFrame(geometry=[route], crs='EPSG:4326')
-        
-        def split_line(line):
-            return [LineString([line.coords[i], line.coords[i+1]]) 
-                    for i in range(len(line.coords) - 1)]
-        
-        gdf['segments'] = gdf.geometry.apply(split_line)
-        
-        gdf = gdf.explode('segments')
-        gdf = gdf.reset_index(drop=True)
-        gdf['geometry'] = gdf['segments']
-        gdf = gdf.drop(columns=['segments'])
-        
-        gdf['surface'] = None
-        for start, end, surface_id in details:
-            gdf.loc[start:end, 'surface'] = surface_id
-        
-        return gdf
-
     route_detailed = add_road_surface_id(route_geom, surface_details)
 
-    surface_codes = {
-        0: "Unknown", 1: "Paved", 2: "Unpaved", 3: "Asphalt", 4: "Concrete",
-        6: "Metal", 7: "Wood", 8: "Compacted Gravel", 10: "Gravel", 11: "Dirt",
-        12: "Ground", 13: "Ice", 14: "Paving Stones", 15: "Sand", 17: "Grass",
-        18: "Grass Paver"
-    }
-    route_detailed['surface'] = route_detailed['surface'].map(lambda x: surface_codes.get(x, "Unknown"))
-
-    route_detailed = route_detailed.to_crs(route_detailed.estimate_utm_crs())
-    route_detailed['segment_length'] = route_detailed.geometry.length
-    
-    cols = [col for col in route_detailed if col != 'geometry'] + ['geometry']
-    route_detailed = route_detailed[cols]
-    route_detailed = route_detailed.to_crs('EPSG:4326')
-
     surface_summary_api = pd.DataFrame(surface_summary)
     surface_summary_api['value'] = surface_summary_api['value'].astype(int)
-    surface_summary_api['surface'] = surface_summary_api['value'].map(lambda x: surface_codes.get(x, "Unknown"))
+    surface_summary_api['surface'] = surface_summary_api['value'].map(surface_codes).fillna("Unknown")
 
     return route_detailed, source, final_stop, destinations, route_segments, input_dest_id_field
\ No newline at end of file
@@ -1,25 +1,25 @@
 import shiny
 from shiny import App, render, ui, reactive
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import openrouteservice as ors
-import folium
-from folium import MacroElement
-from jinja2 import Template
+import pyogrio
+import shapely
 import os
-import time
-import tempfile
-from caculate_optimal_route import optimal_route
+import json
+import html
+import io
+import functools
+import hashlib
+import collections
 
-# Load auxiliary layers
-lakes = gpd.read_file(os.path.join(os.path.dirname(__file__),  'data_wgs84', 'RW_lakes.gpkg'))
-np = gpd.read_file(os.path.join(os.path.dirname(__file__), 'data_wgs84', 'RW_national_parks.gpkg'))
-country = gpd.read_file(os.path.join(os.path.dirname(__file__), 'data_wgs84', 'RW_country.gpkg'))
+# Use pyogrio (vectorized GDAL I/O) instead of Fiona for all GeoPandas reads/writes
+gpd.options.io_engine = "pyogrio"
 
 # Load pre-defined destinations database
 # The data is provided as a CSV and has these columns: name, latitude, longitude, category (optional)
 try:
-    destinations_db = pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', 'destinations_database.csv'))
+    destinations_db = pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', 'destinations_database.csv'), engine='pyarrow')
     destinations_db.columns = destinations_db.columns.str.lower().str.replace(' ', '_')
     # Ensure required columns exist
     required_cols = ['name', 'latitude', 'longitude']
@@ -28,7 +28,7 @@ try:
     destinations_available = True
 
     # Create choices for the select inputs (name as both key and value, index as internal reference)
-    destination_choices = {str(idx): row['name'] for idx, row in destinations_db.iterrows()}
+    destination_choices = dict(zip(map(str, range(len(destinations_db))), destinations_db['name'].tolist()))
 
     # Group by category if available for better organization
     if 'category' in destinations_db.columns:
@@ -38,16 +38,282 @@ try:
         categories = None
         category_choices = {}
 
+    # Lowercased search fields and per-category row positions, computed once instead of on every keystroke
+    name_lc = destinations_db['name'].fillna('').astype(str).str.lower().to_numpy(dtype=str)
+    if 'description' in destinations_db.columns:
+        description_lc = destinations_db['description'].fillna('').astype(str).str.lower().to_numpy(dtype=str)
+    else:
+        description_lc = None
+    category_index = destinations_db.groupby('category', sort=False).indices if categories is not None else {}
+
+    # Columnar view of the database for positional lookups of the selected destinations
+    db_columns = {col: destinations_db[col].to_numpy() for col in destinations_db.columns}
+
+    # Checkbox labels ("name - description" when a description is given), built once for all renders
+    checkbox_labels = destinations_db['name'].astype(str)
+    if 'description' in destinations_db.columns:
+        has_description = destinations_db['description'].notna()
+        checkbox_labels = checkbox_labels.where(~has_description, checkbox_labels + ' - ' + destinations_db['description'].astype(str))
+    checkbox_labels = checkbox_labels.tolist()
+
 except (FileNotFoundError, Exception) as e:
     print(f"Warning: Could not load destinations database: {e}")
     destinations_available = False
     destination_choices = {}
     categories = None
     category_choices = {}
+    name_lc = description_lc = None
+    category_index = {}
+    db_columns = {}
+    checkbox_labels = []
+
+# Positions of the destinations matching the category filter and the (case-insensitive) search term
+def matching_destinations(search_term, category_filter):
+    if category_filter:
+        positions = category_index.get(category_filter, np.empty(0, dtype=np.int64))
+    else:
+        positions = np.arange(len(name_lc))
+    # Only scan the rows of the selected category
+    if search_term:
+        term = search_term.lower()
+        found = np.char.find(name_lc[positions], term) >= 0
+        if description_lc is not None:
+            found |= np.char.find(description_lc[positions], term) >= 0
+        positions = positions[found]
+    return positions
+
+# Load auxiliary layers on first use (the map is the only consumer) rather than at import
+@functools.lru_cache(maxsize=1)
+def aux_layers():
+    # Only read the attributes we need, and only features within the country extent
+    country = gpd.read_file(os.path.join(os.path.dirname(__file__), 'data_wgs84', 'RW_country.gpkg'),
+                            engine="pyogrio", use_arrow=True, columns=['country_na'])
+    country_bbox = tuple(country.total_bounds)
+    lakes = gpd.read_file(os.path.join(os.path.dirname(__file__),  'data_wgs84', 'RW_lakes.gpkg'),
+                          engine="pyogrio", use_arrow=True, columns=['name'], bbox=country_bbox)
+    national_parks = gpd.read_file(os.path.join(os.path.dirname(__file__), 'data_wgs84', 'RW_national_parks.gpkg'),
+                                   engine="pyogrio", use_arrow=True, columns=['name'], bbox=country_bbox)
+
+    # Clip lakes and national parks to the country extent and dissolve each layer into a single (multi)polygon
+    lakes = gpd.clip(lakes, shapely.box(*country_bbox)).dissolve()
+    national_parks = gpd.clip(national_parks, shapely.box(*country_bbox)).dissolve()
+
+    # Simplify the auxiliary layers for display (tolerances in degrees, tuned for zoom ~8.5)
+    # and snap their coordinates to 6 decimals to keep the GeoJSON embedded in the map small
+    for layer, tolerance in ((country, 0.001), (national_parks, 0.001), (lakes, 0.0005)):
+        simplified = layer.geometry.simplify(tolerance, preserve_topology=True)
+        layer['geometry'] = gpd.GeoSeries(shapely.set_precision(simplified.values, 1e-6), index=layer.index, crs=layer.crs)
+
+    return country, lakes, national_parks
+
+# Country centroid as [lat, lon]; read from the precomputed constant, falling back to the country layer
+@functools.lru_cache(maxsize=1)
+def country_center():
+    try:
+        with open(os.path.join(os.path.dirname(__file__), 'data_wgs84', 'center_coords.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        country = aux_layers()[0]
+        # Use a projected CRS before calculating the centroid
+        centroid = country.to_crs(country.estimate_utm_crs()).geometry.centroid.to_crs('EPSG:4326').iloc[0]
+        return [centroid.y, centroid.x]
+
+# Naming modal shown after a map click, per click mode
+click_modals = {
+    'source': {'key': 'source', 'title': "Name the Starting Point", 'placeholder': "e.g., My Office",
+               'default_name': "Starting Point", 'saved': "Starting point '{}' saved!", 'button': "Save", 'button_class': "btn-success"},
+    'final': {'key': 'final_stop', 'title': "Name the Final Stop", 'placeholder': "e.g., Airport",
+              'default_name': "Final Stop", 'saved': "Final stop '{}' saved!", 'button': "Save", 'button_class': "btn-warning"},
+    'destination': {'key': 'destinations', 'title': "Name the Destination", 'placeholder': "e.g., Tourist Site",
+                    'saved': "Destination '{}' added!", 'button': "Add", 'button_class': "btn-info"}
+}
+
+# Style functions for the auxiliary layers
+def style_country(feature):
+    return {
+        'fillColor': '#acbbb4',
+        'color': '#3f4b46',
+        'weight': 4,
+        'fillOpacity': 0.2
+    }
+
+def style_lakes(feature):
+    return {
+        'fillColor': '#37a3bd',
+        'color': '#345a6a',
+        'weight': 1,
+        'fillOpacity': 0.6
+    }
+
+def style_np(feature):
+    return {
+        'fillColor': '#13764b',
+        'color': '#006600',
+        'weight': 2,
+        'fillOpacity': 0.6
+    }
+
+def build_base_map():
+    import folium  # imported here so that app start-up does not pay for folium
+
+    country, lakes, national_parks = aux_layers()
+
+    # Map center: the country centroid ([lat, lon]) precomputed in a projected CRS and stored next to the layers
+    center_coords = country_center()
+
+    # Create a map centered on the country and remove OSM as the default basemap
+    m = folium.Map(location=center_coords, zoom_start=8.5)
+
+    # Remove the default OpenStreetMap layer; we will add it again last
+    for key in list(m._children.keys()):
+        if key.startswith('openstreetmap'):
+            del m._children[key]
+    
+    # Add some optional basemaps
+    folium.TileLayer('CartoDB positron', name='CartoDB Positron').add_to(m)
+
+    folium.TileLayer(
+        tiles='https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}',
+        attr='Google',
+        name='Google Satellite'
+    ).add_to(m)
+
+    folium.TileLayer(
+        tiles='https://mt1.google.com/vt/lyrs=p&x={x}&y={y}&z={z}',
+        attr='Google',
+        name='Google Terrain'
+    ).add_to(m)
+
+    folium.TileLayer('OpenStreetMap', name='Open Street Map').add_to(m) # add OSM last to make it the default
+
+    # Add layers
+    folium.GeoJson(country.__geo_interface__, style_function=style_country, name="Country Border", control=False).add_to(m)
+    folium.GeoJson(national_parks.__geo_interface__, style_function=style_np, name="National Parks", control=False).add_to(m)
+    folium.GeoJson(lakes.__geo_interface__, style_function=style_lakes, name="Lakes", control=False).add_to(m)
+
+    # Add the Layer Control 
+    folium.LayerControl(collapsed=True, overlays=False).add_to(m)
+
+    return m
+
+# The base map (basemaps and auxiliary layers) never changes: render it to HTML once, on the first
+# map render, and only append the per-render overlays (route, markers, click handler) as a Leaflet script
+@functools.lru_cache(maxsize=1)
+def base_map_page():
+    m = build_base_map()
+    return m.get_name(), m.get_root().render()
+
+# Send map clicks to Shiny as the `map_clicked_coords` input
+map_click_js = """
+function getLatLng(e) {
+    var lat = e.latlng.lat.toFixed(6),
+        lng = e.latlng.lng.toFixed(6);
+    parent.Shiny.setInputValue('map_clicked_coords', {
+        lat: parseFloat(lat),
+        lng: parseFloat(lng),
+        timestamp: new Date().getTime()
+    }, {priority: 'event'});
+}
+route_map.on('click', getLatLng);
+"""
+
+def marker_options(color, icon):
+    # Leaflet marker options equivalent to a folium.Icon (default marker when no color is given)
+    if color is None:
+        return ""
+    icon_options = json.dumps({'markerColor': color, 'iconColor': 'white', 'icon': icon, 'prefix': 'glyphicon', 'extraClasses': 'fa-rotate-0'})
+    return f", {{icon: L.AwesomeMarkers.icon({icon_options})}}"
+
+def leaflet_marker(lat, lon, popup=None, tooltip=None, color=None, icon='info-sign'):
+    # Leaflet equivalent of folium.Marker (with a folium.Icon when a color is given)
+    js = f"L.marker({json.dumps([float(lat), float(lon)])}{marker_options(color, icon)})"
+    if popup is not None:
+        js += f".bindPopup({json.dumps(html.escape(str(popup)))})"
+    if tooltip is not None:
+        js += f".bindTooltip({json.dumps(html.escape(str(tooltip)))}, {{sticky: true}})"
+    return js + ".addTo(route_map);"
+
+def leaflet_markers(lats, lons, popups, tooltips, color=None, icon='info-sign'):
+    # Many markers at once: ship one JSON array of [lat, lon, popup, tooltip] rows and build the markers client-side
+    rows = [[float(lat), float(lon), html.escape(str(popup)), html.escape(str(tooltip))]
+            for lat, lon, popup, tooltip in zip(lats, lons, popups, tooltips)]
+    return (
+        f"{json.dumps(rows)}.forEach(function (d) {{ "
+        f"L.marker([d[0], d[1]]{marker_options(color, icon)}).bindPopup(d[2]).bindTooltip(d[3], {{sticky: true}}).addTo(route_map); }});"
+    )
 
-# Get the centroid of the country (use a projected CRS before calculating centroids)
-centroid = country.to_crs(country.estimate_utm_crs()).geometry.centroid.to_crs('EPSG:4326').iloc[0]
-center_coords = [centroid.y, centroid.x]
+def render_map(overlays):
+    # Append the overlay script (which refers to the map as `route_map`) to the pre-rendered base map
+    # and embed it the way folium does (an iframe srcdoc)
+    map_name, base_map_html = base_map_page()
+    head, _, tail = base_map_html.rpartition('</html>')
+    page = head + f"<script>\nvar route_map = {map_name};\n" + "\n".join(overlays) + "\n</script>\n</html>" + tail
+    return (
+        '<div style="width:100%;"><div style="position:relative;width:100%;height:0;padding-bottom:60%;">'
+        f'<iframe srcdoc="{html.escape(page)}" style="position:absolute;width:100%;height:100%;left:0;top:0;border:none !important;" '
+        'allowfullscreen webkitallowfullscreen mozallowfullscreen></iframe>'
+        '</div></div>'
+    )
+
+# The map without any overlay (e.g. before a route is calculated) never changes; embed it once
+@functools.lru_cache(maxsize=1)
+def empty_map():
+    return render_map([])
+
+# Most recent route results, keyed on a hash of the optimal_route inputs, so that recalculating
+# an unchanged route (e.g. a double click on the button) does not redo the work
+route_results = collections.OrderedDict()
+route_results_size = 4
+
+def cached_optimal_route(source_df, dest_df, id_field, final_df):
+    # imported here so that app start-up does not pay for the ORS client stack (httpx, diskcache, pyproj)
+    from caculate_optimal_route import optimal_route
+
+    digest = hashlib.blake2b(str(id_field).encode(), digest_size=16)
+    for df in (source_df, dest_df, final_df):
+        digest.update(json.dumps(df.columns.tolist(), default=str).encode())
+        digest.update(str(df.dtypes.to_dict()).encode())  # values that only differ in type (1 vs '1') hash alike
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    key = digest.hexdigest()
+
+    if key in route_results:
+        route_results.move_to_end(key)
+        return route_results[key]
+
+    route_detailed, source, final_stop, destinations, route_segments, used_id_field = optimal_route(
+        source_df, dest_df, id_field, final_df
+    )
+    result = {
+        'route_detailed': route_detailed,
+        'source': source,
+        'final_stop': final_stop,
+        'destinations': destinations,
+        'route_segments': route_segments,
+        'used_id_field': used_id_field
+    }
+
+    # (lat, lon) of the start and end points, read once for the map markers
+    result['source_latlon'] = (source.geometry.iloc[0].y, source.geometry.iloc[0].x)
+    result['final_latlon'] = (final_stop.geometry.iloc[0].y, final_stop.geometry.iloc[0].x)
+
+    # Summarize the length (km) and share of each surface category once per route, for the statistics modal;
+    # grouping a single column leaves the geometry alone
+    surface_km = route_detailed.groupby('surface', sort=False, observed=True)['segment_length'].sum() / 1000
+    total_length = surface_km.sum()
+    result['surface_stats'] = pd.DataFrame({
+        'Surface Type': surface_km.index.astype(str),
+        'Length (km)': surface_km.to_numpy(),
+        'Percentage': (surface_km / total_length * 100).to_numpy()
+    }).sort_values('Length (km)', ascending=False)
+    result['total_length_km'] = total_length
+
+    # Serialize the segments table once; repeated downloads just send the bytes
+    result['route_segments_csv'] = route_segments.to_csv(index=False).encode('utf-8')
+
+    route_results[key] = result
+    if len(route_results) > route_results_size:
+        route_results.popitem(last=False)
+    return result
 
 # UI
 app_ui = ui.page_fluid(
@@ -149,12 +415,17 @@ app_ui = ui.page_fluid(
 )
 
 def server(input, output, session):
-    # Reactive values for uploaded files
-    uploaded_files = reactive.Value({
-        'source': None,
-        'final_stop': None,
-        'destinations': None
-    })
+    # Reactive values for uploaded files (one per file, so an upload only invalidates its own value)
+    uploaded_source = reactive.Value(None)
+    uploaded_final_stop = reactive.Value(None)
+    uploaded_destinations = reactive.Value(None)
+
+    def uploaded_files():
+        return {
+            'source': uploaded_source(),
+            'final_stop': uploaded_final_stop(),
+            'destinations': uploaded_destinations()
+        }
 
     # Reactive values for database selection
     selected_destinations = reactive.Value([])  # This will store all selected destination indices persistently
@@ -165,7 +436,11 @@ def server(input, output, session):
 
     # Map click functionality
     map_click_mode = reactive.Value("none")
-    map_clicked_points = reactive.Value({'source': None, 'final_stop': None, 'destinations': []})
+    # Clicked destinations are kept column-wise (parallel name/latitude/longitude lists)
+    def empty_click_points():
+        return {'source': None, 'final_stop': None, 'destinations': {'name': [], 'latitude': [], 'longitude': []}}
+
+    map_clicked_points = reactive.Value(empty_click_points())
 
     # Render conditional input controls
     @render.ui
@@ -258,18 +533,7 @@ def server(input, output, session):
             category_filter = input.category_filter() if hasattr(input, 'category_filter') else ""
 
             # Filter destinations based on search and category (same logic as in render function)
-            filtered_db = destinations_db.copy()
-
-            if category_filter:
-                filtered_db = filtered_db[filtered_db['category'] == category_filter]
-
-            if search_term:
-                mask = filtered_db['name'].str.contains(search_term, case=False, na=False)
-                if 'description' in filtered_db.columns:
-                    mask |= filtered_db['description'].str.contains(search_term, case=False, na=False)
-                filtered_db = filtered_db[mask]
-
-            current_view_indices = [str(idx) for idx, row in filtered_db.iterrows()]
+            current_view_indices = {str(idx) for idx in matching_destinations(search_term, category_filter)}
 
             # Remove any previous selections that are in current view (to handle deselections)
             updated_selections = [sel for sel in persistent_selections if sel not in current_view_indices]
@@ -280,7 +544,9 @@ def server(input, output, session):
             # Remove duplicates while preserving order
             updated_selections = list(dict.fromkeys(updated_selections))
 
-            selected_destinations.set(updated_selections)
+            # Only publish a change, so the selection summary is not recomputed for an identical list
+            if updated_selections != persistent_selections:
+                selected_destinations.set(updated_selections)
 
     # Clear all selections
     @reactive.Effect
@@ -303,29 +569,12 @@ def server(input, output, session):
         search_term = input.destination_search() or ""
         category_filter = input.category_filter() if hasattr(input, 'category_filter') else ""
 
-        # Filter destinations based on search and category
-        filtered_db = destinations_db.copy()
-
-        if category_filter:
-            filtered_db = filtered_db[filtered_db['category'] == category_filter]
-
-        if search_term:
-            mask = filtered_db['name'].str.contains(search_term, case=False, na=False)
-            if 'description' in filtered_db.columns:
-                mask |= filtered_db['description'].str.contains(search_term, case=False, na=False)
-            filtered_db = filtered_db[mask]
-
-        # Create checkbox choices
-        choices = {}
-        for idx, row in filtered_db.iterrows():
-            display_name = row['name']
-            if 'description' in row and pd.notna(row['description']):
-                display_name += f" - {row['description']}"
-            choices[str(idx)] = display_name
+        # Filter destinations based on search and category and create the checkbox choices
+        choices = {str(idx): checkbox_labels[idx] for idx in matching_destinations(search_term, category_filter)}
 
         # Get persistent selections that are in the current filtered view
         persistent_selections = selected_destinations() or []
-        current_view_selections = [s for s in persistent_selections if s in choices.keys()]
+        current_view_selections = [s for s in persistent_selections if s in choices]
 
         # Show count of selections in current view vs total
         total_selections = len(persistent_selections)
@@ -349,45 +598,49 @@ def server(input, output, session):
             class_="destination-selector"
         )
 
-    # Display selected destinations
-    @render.ui
-    def selected_destinations_display():
+    # Summary of the selected destinations (count, per-category counts and names); only
+    # recomputed when the persistent selections change
+    @reactive.Calc
+    def selected_summary():
         persistent_selections = selected_destinations() or []
         if not persistent_selections or not destinations_available:
-            return ui.div()
+            return None
 
-        selected_names = []
-        categories_count = {}
+        positions = np.fromiter((int(idx_str) for idx_str in persistent_selections), dtype=np.int64)
+        positions = positions[positions < len(destinations_db)]
+        selected_names = db_columns['name'][positions].astype(str)
 
-        for idx_str in persistent_selections:
-            try:
-                idx = int(idx_str)
-                if idx < len(destinations_db):
-                    row = destinations_db.iloc[idx]
-                    name = row['name']
-                    category = row.get('category', 'Unknown') if 'category' in destinations_db.columns else 'Unknown'
+        if 'category' in db_columns:
+            selected_categories = db_columns['category'][positions]
+            has_category = pd.notna(selected_categories)
+            selected_categories = np.where(has_category, selected_categories, 'Unknown').astype(str)
+            selected_names = np.where(has_category, np.char.add(selected_names, np.char.add(' (', np.char.add(selected_categories, ')'))), selected_names)
+        else:
+            selected_categories = np.full(len(positions), 'Unknown')
 
-                    # Count by category
-                    categories_count[category] = categories_count.get(category, 0) + 1
+        if len(selected_names):
+            # Create category summary
+            category_labels, category_counts = np.unique(selected_categories, return_counts=True)
+            category_summary = ", ".join([f"{cat}: {count}" for cat, count in zip(category_labels, category_counts)])
 
-                    if 'category' in row and pd.notna(row['category']):
-                        name += f" ({row['category']})"
-                    selected_names.append(name)
-            except (ValueError, IndexError):
-                continue
+            return len(selected_names), category_summary, "<br>".join(selected_names)
+        return None
 
-        if selected_names:
-            # Create category summary
-            category_summary = ", ".join([f"{cat}: {count}" for cat, count in sorted(categories_count.items())])
+    # Display selected destinations
+    @render.ui
+    def selected_destinations_display():
+        summary = selected_summary()
+        if summary is None:
+            return ui.div()
 
-            return ui.div(
-                ui.strong(f"Selected destinations ({len(selected_names)}):"),
-                ui.p(f"By category: {category_summary}", style="font-size: 12px; color: #666; margin: 2px 0;"),
-                ui.br(),
-                ui.HTML("<br>".join(selected_names)),
-                class_="selected-destinations"
-            )
-        return ui.div()
+        count, category_summary, names_html = summary
+        return ui.div(
+            ui.strong(f"Selected destinations ({count}):"),
+            ui.p(f"By category: {category_summary}", style="font-size: 12px; color: #666; margin: 2px 0;"),
+            ui.br(),
+            ui.HTML(names_html),
+            class_="selected-destinations"
+        )
 
     # Map click mode handlers
     @reactive.Effect
@@ -411,7 +664,7 @@ def server(input, output, session):
     @reactive.Effect
     @reactive.event(input.clear_map_points)
     def _():
-        map_clicked_points.set({'source': None, 'final_stop': None, 'destinations': []})
+        map_clicked_points.set(empty_click_points())
         map_click_mode.set("none")
         ui.notification_show("All map points cleared", type="message")
 
@@ -420,99 +673,54 @@ def server(input, output, session):
     @reactive.event(input.map_clicked_coords)
     def _():
         coords = input.map_clicked_coords()
-        mode = map_click_mode()
-        if not coords or mode == "none":
+        modal = click_modals.get(map_click_mode())
+        if not coords or modal is None:
             return
 
         lat, lng = coords['lat'], coords['lng']
 
-        if mode == "source":
-            ui.modal_show(ui.modal(
-                ui.h4("Name the Starting Point"),
-                ui.input_text("point_name_input", "Enter name:", placeholder="e.g., My Office"),
-                ui.p(f"Coordinates: {lat:.6f}, {lng:.6f}", style="color: #666; font-size: 12px;"),
-                footer=[ui.input_action_button("save_source_point", "Save", class_="btn-success"), ui.modal_button("Cancel")],
-                easy_close=True
-            ))
-        elif mode == "final":
-            ui.modal_show(ui.modal(
-                ui.h4("Name the Final Stop"),
-                ui.input_text("point_name_input", "Enter name:", placeholder="e.g., Airport"),
-                ui.p(f"Coordinates: {lat:.6f}, {lng:.6f}", style="color: #666; font-size: 12px;"),
-                footer=[ui.input_action_button("save_final_point", "Save", class_="btn-warning"), ui.modal_button("Cancel")],
-                easy_close=True
-            ))
-        elif mode == "destination":
-            ui.modal_show(ui.modal(
-                ui.h4("Name the Destination"),
-                ui.input_text("point_name_input", "Enter name:", placeholder="e.g., Tourist Site"),
-                ui.p(f"Coordinates: {lat:.6f}, {lng:.6f}", style="color: #666; font-size: 12px;"),
-                footer=[ui.input_action_button("save_dest_point", "Add", class_="btn-info"), ui.modal_button("Cancel")],
-                easy_close=True
-            ))
-
-    # Save clicked points
-    @reactive.Effect
-    @reactive.event(input.save_source_point)
-    def _():
-        coords = input.map_clicked_coords()
-        name = input.point_name_input() or "Starting Point"
-        if coords:
-            current_points = map_clicked_points()
-            current_points['source'] = {'name': name, 'latitude': coords['lat'], 'longitude': coords['lng']}
-            map_clicked_points.set(current_points)
-            map_click_mode.set("none")
-            ui.modal_remove()
-            ui.notification_show(f"Starting point '{name}' saved!", type="success")
-            rerender_trigger.set(rerender_trigger() + 1) # Trigger map update
+        ui.modal_show(ui.modal(
+            ui.h4(modal['title']),
+            ui.input_text("point_name_input", "Enter name:", placeholder=modal['placeholder']),
+            ui.p(f"Coordinates: {lat:.6f}, {lng:.6f}", style="color: #666; font-size: 12px;"),
+            footer=[ui.input_action_button("save_point", modal['button'], class_=modal['button_class']), ui.modal_button("Cancel")],
+            easy_close=True
+        ))
 
+    # Save clicked points (one handler for all modes; the mode decides where the point goes)
     @reactive.Effect
-    @reactive.event(input.save_final_point)
+    @reactive.event(input.save_point)
     def _():
         coords = input.map_clicked_coords()
-        name = input.point_name_input() or "Final Stop"
-        if coords:
-            current_points = map_clicked_points()
-            current_points['final_stop'] = {'name': name, 'latitude': coords['lat'], 'longitude': coords['lng']}
-            map_clicked_points.set(current_points)
-            map_click_mode.set("none")
-            ui.modal_remove()
-            ui.notification_show(f"Final stop '{name}' saved!", type="success")
-            rerender_trigger.set(rerender_trigger() + 1) # Trigger map update
+        mode = map_click_mode()
+        if not coords or mode not in click_modals:
+            return
 
-    @reactive.Effect
-    @reactive.event(input.save_dest_point)
-    def _():
-        coords = input.map_clicked_coords()
-        name = input.point_name_input() or f"Destination {len(map_clicked_points()['destinations']) + 1}"
-        if coords:
-            current_points = map_clicked_points()
-            current_points['destinations'].append({'name': name, 'latitude': coords['lat'], 'longitude': coords['lng']})
-            map_clicked_points.set(current_points)
-            ui.modal_remove()
-            ui.notification_show(f"Destination '{name}' added!", type="success")
-            rerender_trigger.set(rerender_trigger() + 1) # Trigger map update
+        modal = click_modals[mode]
+        current_points = map_clicked_points()
+        if mode == "destination":
+            destinations = current_points['destinations']
+            name = input.point_name_input() or f"Destination {len(destinations['name']) + 1}"
+            destinations['name'].append(name)
+            destinations['latitude'].append(coords['lat'])
+            destinations['longitude'].append(coords['lng'])
+        else:
+            name = input.point_name_input() or modal['default_name']
+            current_points[modal['key']] = {'name': name, 'latitude': coords['lat'], 'longitude': coords['lng']}
+            map_click_mode.set("none")
+        map_clicked_points.set(current_points)
+        ui.modal_remove()
+        ui.notification_show(modal['saved'].format(name), type="success")
+        rerender_trigger.set(rerender_trigger() + 1) # Trigger map update
 
     # Rerender map display every time a new point is clicked
     rerender_trigger = reactive.Value(0)
 
-    # Add reactive effects to handle category and search changes
-    @reactive.Effect
-    @reactive.event(input.category_filter)
-    def _():
-        # When category filter changes, we don't need to do anything special
-        # The render function will automatically show the right selections
-        # This effect is here to ensure reactivity works properly
-        pass
-
-    # Add a reactive effect to handle search changes
-    @reactive.Effect
-    @reactive.event(input.destination_search)
-    def _():
-        # When search term changes, we don't need to do anything special
-        # The render function will automatically show the right selections
-        # This effect is here to ensure reactivity works properly
-        pass
+    # Shared reader for the three uploaded point files (multithreaded pyarrow CSV parser, normalized column names)
+    def read_points_csv(file):
+        df = pd.read_csv(file[0]['datapath'], engine='pyarrow')
+        df.columns = df.columns.str.lower().str.replace(' ', '_')
+        return df
 
     # File upload handlers (existing code)
     @reactive.Effect
@@ -520,27 +728,24 @@ def server(input, output, session):
     def _():
         file = input.source()
         if file and len(file) > 0:
-            df = pd.read_csv(file[0]['datapath'])
-            uploaded_files.set({**uploaded_files(), 'source': df})
+            uploaded_source.set(read_points_csv(file))
 
     @reactive.Effect
     @reactive.event(input.final_stop)
     def _():
         file = input.final_stop()
         if file and len(file) > 0:
-            df = pd.read_csv(file[0]['datapath'])
-            uploaded_files.set({**uploaded_files(), 'final_stop': df})
+            uploaded_final_stop.set(read_points_csv(file))
 
     @reactive.Effect
     @reactive.event(input.destinations)
     def _():
         file = input.destinations()
         if file and len(file) > 0:
-            df = pd.read_csv(file[0]['datapath'])
-            df.columns = df.columns.str.lower().str.replace(' ', '_')
+            df = read_points_csv(file)
             if 'name' in df.columns:
                 df = df.rename(columns={'name': 'name_dest'})
-            uploaded_files.set({**uploaded_files(), 'destinations': df})
+            uploaded_destinations.set(df)
             dest_id_choices.set(df.columns.tolist())
 
     @reactive.Effect
@@ -575,34 +780,29 @@ def server(input, output, session):
 
         try:
             # Prepare source dataframe
-            source_row = destinations_db.iloc[int(source_idx)]
+            source_pos = [int(source_idx)]
             source_df = pd.DataFrame({
-                'latitude': [source_row['latitude']],
-                'longitude': [source_row['longitude']],
-                'name': [source_row['name']]
+                'latitude': db_columns['latitude'][source_pos],
+                'longitude': db_columns['longitude'][source_pos],
+                'name': db_columns['name'][source_pos]
             })
 
             # Prepare final stop dataframe
-            final_row = destinations_db.iloc[int(final_stop_idx)]
+            final_pos = [int(final_stop_idx)]
             final_df = pd.DataFrame({
-                'latitude': [final_row['latitude']],
-                'longitude': [final_row['longitude']],
-                'name': [final_row['name']]
+                'latitude': db_columns['latitude'][final_pos],
+                'longitude': db_columns['longitude'][final_pos],
+                'name': db_columns['name'][final_pos]
             })
 
-            # Prepare destinations dataframe
-            dest_rows = []
-            for idx_str in dest_indices:
-                idx = int(idx_str)
-                row = destinations_db.iloc[idx]
-                dest_rows.append({
-                    'latitude': row['latitude'],
-                    'longitude': row['longitude'],
-                    'name': row['name'],
-                    'destination_id': row['name']
-                })
-
-            dest_df = pd.DataFrame(dest_rows)
+            # Prepare destinations dataframe (one fancy-indexing op per column)
+            dest_pos = np.fromiter((int(idx_str) for idx_str in dest_indices), dtype=np.int64)
+            dest_df = pd.DataFrame({
+                'latitude': db_columns['latitude'][dest_pos],
+                'longitude': db_columns['longitude'][dest_pos],
+                'name': db_columns['name'][dest_pos],
+                'destination_id': db_columns['name'][dest_pos]
+            })
 
             return source_df, final_df, dest_df, 'destination_id'
 
@@ -613,7 +813,7 @@ def server(input, output, session):
     #  helper function to prepare map click data
     def prepare_map_click_data():
         points = map_clicked_points()
-        if not points['source'] or not points['final_stop'] or not points['destinations']:
+        if not points['source'] or not points['final_stop'] or not points['destinations']['name']:
             return None, None, None, None
 
         try:
@@ -629,13 +829,11 @@ def server(input, output, session):
                 'name': [points['final_stop']['name']]
             })
 
-            dest_rows = []
-            for dest in points['destinations']:
-                dest_rows.append({
-                    'latitude': dest['latitude'], 'longitude': dest['longitude'],
-                    'name': dest['name'], 'destination_id': dest['name']
-                })
-            dest_df = pd.DataFrame(dest_rows)
+            destinations = points['destinations']
+            dest_df = pd.DataFrame({
+                'latitude': destinations['latitude'], 'longitude': destinations['longitude'],
+                'name': destinations['name'], 'destination_id': destinations['name']
+            })
 
             return source_df, final_df, dest_df, 'destination_id'
         except Exception as e:
@@ -653,20 +851,7 @@ def server(input, output, session):
             id_field = dest_id_field()
             if all(df is not None and not df.empty for df in files.values()) and id_field:
                 try:
-                    route_detailed, source, final_stop, destinations, route_segments, used_id_field = optimal_route(
-                        files['source'],
-                        files['destinations'],
-                        id_field,
-                        files['final_stop']
-                    )
-                    return {
-                        'route_detailed': route_detailed,
-                        'source': source,
-                        'final_stop': final_stop,
-                        'destinations': destinations,
-                        'route_segments': route_segments,
-                        'used_id_field': used_id_field
-                    }
+                    return cached_optimal_route(files['source'], files['destinations'], id_field, files['final_stop'])
                 except Exception as e:
                     ui.notification_show(f"Error: {str(e)}", type="error")
                     return None
@@ -674,13 +859,7 @@ def server(input, output, session):
             source_df, final_df, dest_df, id_field = prepare_map_click_data()
             if source_df is not None and final_df is not None and dest_df is not None:
                 try:
-                    route_detailed, source, final_stop, destinations, route_segments, used_id_field = optimal_route(
-                        source_df, dest_df, id_field, final_df
-                    )
-                    return {
-                        'route_detailed': route_detailed, 'source': source, 'final_stop': final_stop,
-                        'destinations': destinations, 'route_segments': route_segments, 'used_id_field': used_id_field
-                    }
+                    return cached_optimal_route(source_df, dest_df, id_field, final_df)
                 except Exception as e:
                     ui.notification_show(f"Error: {str(e)}", type="error")
                     return None
@@ -689,20 +868,7 @@ def server(input, output, session):
             source_df, final_df, dest_df, id_field = prepare_database_data()
             if source_df is not None and final_df is not None and dest_df is not None:
                 try:
-                    route_detailed, source, final_stop, destinations, route_segments, used_id_field = optimal_route(
-                        source_df,
-                        dest_df,
-                        id_field,
-                        final_df
-                    )
-                    return {
-                        'route_detailed': route_detailed,
-                        'source': source,
-                        'final_stop': final_stop,
-                        'destinations': destinations,
-                        'route_segments': route_segments,
-                        'used_id_field': used_id_field
-                    }
+                    return cached_optimal_route(source_df, dest_df, id_field, final_df)
                 except Exception as e:
                     ui.notification_show(f"Error: {str(e)}", type="error")
                     return None
@@ -758,156 +924,76 @@ def server(input, output, session):
     def map():
         _ = rerender_trigger()  # Make the map depend on this trigger to force rerender when new points are clicked
         try:
-            # Create a map centered on the country and remove OSM as the default basemap
-            m = folium.Map(location=center_coords, zoom_start=8.5)
-
-            # Remove the default OpenStreetMap layer; we will add it again last
-            for key in list(m._children.keys()):
-                if key.startswith('openstreetmap'):
-                    del m._children[key]
-            
-            # Add some optional basemaps
-            folium.TileLayer('CartoDB positron', name='CartoDB Positron').add_to(m)
-
-            folium.TileLayer(
-                tiles='https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}',
-                attr='Google',
-                name='Google Satellite'
-            ).add_to(m)
-
-            folium.TileLayer(
-                tiles='https://mt1.google.com/vt/lyrs=p&x={x}&y={y}&z={z}',
-                attr='Google',
-                name='Google Terrain'
-            ).add_to(m)
-
-            folium.TileLayer('OpenStreetMap', name='Open Street Map').add_to(m) # add OSM last to make it the default
-
-            # Style functions for various layers
-            def style_country(feature):
-                return {
-                    'fillColor': '#acbbb4',
-                    'color': '#3f4b46',
-                    'weight': 4,
-                    'fillOpacity': 0.2
-                }
-
-            def style_lakes(feature):
-                return {
-                    'fillColor': '#37a3bd',
-                    'color': '#345a6a',
-                    'weight': 1,
-                    'fillOpacity': 0.6
-                }
-
-            def style_np(feature):
-                return {
-                    'fillColor': '#13764b',
-                    'color': '#006600',
-                    'weight': 2,
-                    'fillOpacity': 0.6
-                }
-
-            # Add layers
-            folium.GeoJson(country, style_function=style_country, name="Country Border", control=False).add_to(m)
-            folium.GeoJson(np, style_function=style_np, name="National Parks", control=False).add_to(m)
-            folium.GeoJson(lakes, style_function=style_lakes, name="Lakes", control=False).add_to(m)
-
-            # Create a feature group for dynamically added markers
-            dynamic_markers = folium.FeatureGroup(name="Dynamic Markers", control=False).add_to(m)
+            # Nothing dynamic to draw: serve the pre-embedded base map as is
+            if input.input_method() != "map_click" and result() is None:
+                return ui.HTML(empty_map())
+
+            # The base map is pre-rendered; only the dynamic overlays are generated here as Leaflet JS
+            overlays = []
 
             # Add map click functionality
             if input.input_method() == "map_click":
-                map_name = m.get_name()
-                click_macro = Template(f"""
-                    {{% macro script(this, kwargs) %}}
-                    function getLatLng(e) {{
-                        var lat = e.latlng.lat.toFixed(6),
-                            lng = e.latlng.lng.toFixed(6);
-                        parent.Shiny.setInputValue('map_clicked_coords', {{
-                            lat: parseFloat(lat),
-                            lng: parseFloat(lng),
-                            timestamp: new Date().getTime()
-                        }}, {{priority: 'event'}});
-                    }}
-                    {map_name}.on('click', getLatLng);
-                    {{% endmacro %}}
-                """)
-
-                el = MacroElement()
-                el._template = click_macro
-                m.get_root().add_child(el)
+                overlays.append(map_click_js)
 
                 # Add clicked points to map (only if no optimal route is calculated yet)
                 # These markers will be cleared and replaced by the route markers after calculation
                 if result() is None:
                     points = map_clicked_points()
                     if points['source']:
-                        folium.Marker(
-                            location=[points['source']['latitude'], points['source']['longitude']],
+                        overlays.append(leaflet_marker(
+                            points['source']['latitude'], points['source']['longitude'],
                             popup=f"Starting Point: {points['source']['name']}",
-                            icon=folium.Icon(color='lightgreen', icon='play')
-                        ).add_to(dynamic_markers)
+                            color='lightgreen', icon='play'
+                        ))
                     if points['final_stop']:
-                        folium.Marker(
-                            location=[points['final_stop']['latitude'], points['final_stop']['longitude']],
+                        overlays.append(leaflet_marker(
+                            points['final_stop']['latitude'], points['final_stop']['longitude'],
                             popup=f"Final Stop: {points['final_stop']['name']}",
-                            icon=folium.Icon(color='darkpurple', icon='stop')
-                        ).add_to(dynamic_markers)
-                    for i, dest in enumerate(points['destinations'], 1):
-                        folium.Marker(
-                            location=[dest['latitude'], dest['longitude']],
-                            popup=f"Destination {i}: {dest['name']}",
-                            tooltip=dest['name'],
-                            icon=folium.Icon(color='blue', icon='info-sign')
-                        ).add_to(dynamic_markers)
+                            color='darkpurple', icon='stop'
+                        ))
+                    destinations = points['destinations']
+                    overlays.append(leaflet_markers(
+                        destinations['latitude'], destinations['longitude'],
+                        popups=[f"Destination {i}: {name}" for i, name in enumerate(destinations['name'], 1)],
+                        tooltips=destinations['name'],
+                        color='blue', icon='info-sign'
+                    ))
 
             # Get the result value
             result_value = result()
             if result_value is not None:
                 # Add the route to the map
                 route_detailed = result_value['route_detailed']
-                coordinates = []
-                for _, row in route_detailed.iterrows():
-                    if row.geometry.geom_type == 'LineString':
-                        coordinates.extend([(coord[1], coord[0]) for coord in row.geometry.coords])
-                    elif row.geometry.geom_type == 'MultiLineString':
-                        for line in row.geometry:
-                            coordinates.extend([(coord[1], coord[0]) for coord in line.coords])
+                # Extract all vertices in one vectorized call. Each segment is a two-point line starting where the
+                # previous one ended, so keep every segment start plus the last end, then swap to (lat, lon) for Leaflet
+                segment_ends = shapely.get_coordinates(route_detailed.geometry.values).reshape(-1, 2, 2)
+                coordinates = np.concatenate([segment_ends[:, 0], segment_ends[-1:, 1]])[:, ::-1].round(6).tolist()
 
                 # Add the route as a PolyLine
-                folium.PolyLine(coordinates, color='#800000', weight=4, opacity=0.8).add_to(m)
+                overlays.append(
+                    f"L.polyline({json.dumps(coordinates)}, {{color: '#800000', weight: 4, opacity: 0.8}}).addTo(route_map);"
+                )
 
                 # Add the destination points only when result_value is not None
-                folium.Marker(
-                    location=[float(result_value['source'].geometry.y.iloc[0]), float(result_value['source'].geometry.x.iloc[0])],
-                    popup='Starting point',
-                    icon=folium.Icon(color='lightgreen')
-                ).add_to(m)
+                overlays.append(leaflet_marker(*result_value['source_latlon'], popup='Starting point', color='lightgreen'))
 
                 # Add the final point
-                folium.Marker(
-                    location=[float(result_value['final_stop'].geometry.y.iloc[0]), float(result_value['final_stop'].geometry.x.iloc[0])],
-                    popup='Final Stop',
-                    icon=folium.Icon(color='darkpurple')
-                ).add_to(m)
+                overlays.append(leaflet_marker(*result_value['final_latlon'], popup='Final Stop', color='darkpurple'))
 
                 # Add the destinations
                 dest_id = result_value['used_id_field']
-                for _, row in result_value['destinations'].iterrows():
-                    popup_text = str(row[dest_id]) if dest_id in row else "Destination"
-                    tooltip_text = row.get('name', row.get('name_dest', popup_text))
-
-                    folium.Marker(
-                        location=[float(row.geometry.y), float(row.geometry.x)],
-                        popup=popup_text,
-                        tooltip=tooltip_text
-                    ).add_to(m)
-
-            # Add the Layer Control 
-            folium.LayerControl(collapsed=True, overlays=False).add_to(m)
-
-            return ui.HTML(m._repr_html_())
+                destinations = result_value['destinations']
+                popups = destinations[dest_id].astype(str).tolist() if dest_id in destinations.columns else ["Destination"] * len(destinations)
+                if 'name' in destinations.columns:
+                    tooltips = destinations['name'].tolist()
+                elif 'name_dest' in destinations.columns:
+                    tooltips = destinations['name_dest'].tolist()
+                else:
+                    tooltips = popups
+
+                overlays.append(leaflet_markers(destinations.geometry.y.tolist(), destinations.geometry.x.tolist(), popups, tooltips))
+
+            return ui.HTML(render_map(overlays))
         
         except Exception as e:
             print(f"Error in map function: {str(e)}")
@@ -922,25 +1008,10 @@ def server(input, output, session):
 
         route = result_value['route_detailed']
 
-        # Create a temporary file path without creating the file itself
-        tmp_dir = tempfile.gettempdir()
-        tmp_filename = f"route_{os.getpid()}_{int(time.time())}.gpkg"
-        tmp_path = os.path.join(tmp_dir, tmp_filename)
-
-        try:
-            # Write to the temporary file
-            route.to_file(tmp_path, layer="optimal_route", driver="GPKG")
-
-            # Read the file back into memory
-            with open(tmp_path, 'rb') as f:
-                content = f.read()
-
-            yield content
-
-        finally:
-            # Clean up the temporary file
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        # Write the GeoPackage in memory (pyogrio goes through GDAL's /vsimem) instead of a temporary file
+        buffer = io.BytesIO()
+        pyogrio.write_dataframe(route, buffer, layer="optimal_route", driver="GPKG")
+        yield buffer.getvalue()
 
     # Route segments file handler
     @render.download(filename="route_segments.csv")
@@ -948,8 +1019,7 @@ def server(input, output, session):
         result_value = result()
         if result_value is None:
             return
-        route_segments = result_value['route_segments']
-        yield route_segments.to_csv(index=False)
+        yield result_value['route_segments_csv']
 
     # Show route segments in a modal dialog
     @reactive.Effect
@@ -962,28 +1032,12 @@ def server(input, output, session):
 
         route_segments = result_value['route_segments']
 
-        # Create HTML table
-        table_html = "<div style='max-height: 400px; overflow-y: auto;'>"
-        table_html += "<table class='table table-striped table-sm'>"
-        table_html += "<thead><tr>"
-
-        # Add headers
-        for col in route_segments.columns:
-            table_html += f"<th>{col}</th>"
-        table_html += "</tr></thead><tbody>"
-
-        # Add data rows
-        for _, row in route_segments.iterrows():
-            table_html += "<tr>"
-            for col in route_segments.columns:
-                value = row[col]
-                # Format numbers if they are float
-                if isinstance(value, float):
-                    value = f"{value:.2f}"
-                table_html += f"<td>{value}</td>"
-            table_html += "</tr>"
-
-        table_html += "</tbody></table></div>"
+        # Create HTML table (pandas renders all rows in one pass; floats formatted to 2 decimals)
+        table_html = (
+            "<div style='max-height: 400px; overflow-y: auto;'>"
+            + route_segments.to_html(classes='table table-striped table-sm', index=False, border=0, float_format='{:.2f}'.format)
+            + "</div>"
+        )
 
         # Show modal with route segments
         ui.modal_show(
@@ -1005,32 +1059,12 @@ def server(input, output, session):
             ui.notification_show("Please calculate a route first before viewing surface statistics.", type="warning")
             return
 
-        route_detailed = result_value['route_detailed']
-
-        # Convert GeoDataFrame to regular DataFrame
-        df = pd.DataFrame(route_detailed.drop(columns='geometry'))
-
-        # Summarize the length of each surface category
-        surface_stats = df.groupby('surface')['segment_length'].sum().reset_index()
-        surface_stats = surface_stats.rename(columns={'segment_length': 'total_length_m'})
-
-        # Convert total length from meters to kilometers and calculate percentage
-        surface_stats['total_length_km'] = surface_stats['total_length_m'] / 1000
-        total_length = surface_stats['total_length_km'].sum()
-        surface_stats['percentage'] = (surface_stats['total_length_km'] / total_length) * 100
-        surface_stats['total_length_km'] = surface_stats['total_length_km'].round(2)
-        surface_stats['percentage'] = surface_stats['percentage'].round(2)
-        surface_stats = surface_stats.sort_values('total_length_km', ascending=False)
-
-        # Create HTML table
-        table_html = "<table class='table table-striped'>"
-        table_html += "<thead><tr><th>Surface Type</th><th>Length (km)</th><th>Percentage</th></tr></thead><tbody>"
-
-        for _, row in surface_stats.iterrows():
-            table_html += f"<tr><td>{row['surface']}</td><td>{row['total_length_km']}</td><td>{row['percentage']}%</td></tr>"
-
-        table_html += f"</tbody></table>"
-        table_html += f"<p><strong>Total Route Length: {total_length:.2f} km</strong></p>"
+        # Create HTML table from the precomputed summary (the formatters do the rounding)
+        table_html = result_value['surface_stats'].to_html(
+            classes='table table-striped', index=False, border=0,
+            formatters={'Length (km)': '{:.2f}'.format, 'Percentage': '{:.2f}%'.format}
+        )
+        table_html += f"<p><strong>Total Route Length: {result_value['total_length_km']:.2f} km</strong></p>"
 
         # Show modal with statistics
         ui.modal_show(